@@ -18,11 +18,14 @@ class OperationPolicy(Enum):
         return self.__str__()
 
     def __str__(self):
-        if self.value == 1:
-            return "operation_policy_cpu"
-        elif self.value == 2:
-            return "operation_policy_gpu"
-        elif self.value == 3:
-            return "operation_policy_cpu_sparse"
-        else:
-            return "operation_policy_gpu_sparse"
+        return _OPERATION_POLICY_NAMES[self.value]
+
+
+# This lives outside of the class body because Enum would
+# otherwise make it a member.
+_OPERATION_POLICY_NAMES = {
+    1: "operation_policy_cpu",
+    2: "operation_policy_gpu",
+    3: "operation_policy_cpu_sparse",
+    4: "operation_policy_gpu_sparse",
+}
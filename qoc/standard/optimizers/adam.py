@@ -2,10 +2,88 @@
 adam.py - a module for defining the Adam optimizer
 """
 
+from numba import jit, prange, types
 import numpy as np
 
 from qoc.models.operationpolicy import OperationPolicy
 
+# The parameter count from which the threaded kernel is used. Below this
+# the serial loop, roughly 4ns per element, is comparable to the cost of
+# waking numba's thread pool.
+ADAM_PARALLEL_SIZE_MIN = 2 ** 12
+
+# The explicit signature compiles the kernels eagerly, when this module
+# is imported, rather than on the first update of an optimization.
+# Only floating point contraction is allowed, and division follows numpy
+# semantics, so overflowing, infinite or nan gradients propagate as they
+# would through the NumPy path instead of raising ZeroDivisionError.
+# The grads are read only so that broadcast views may be passed.
+_ADAM_STEP_SIGNATURE = types.void(
+    types.float64[::1], types.Array(types.float64, 1, "C", readonly=True),
+    types.float64[::1], types.float64[::1],
+    types.float64, types.float64, types.float64, types.float64,
+    types.float64, types.float64,
+)
+
+@jit(nopython=True, error_model="numpy", fastmath={"contract"}, cache=True,
+     inline="always")
+def _adam_step_element(i, params, grads, gradient_moment,
+                       gradient_square_moment, grads_scale, grads_clip,
+                       step_size, beta_1, beta_2, epsilon_hat):
+    """
+    Update element `i` of the arrays, see `_adam_step`.
+    """
+    # Compare rather than use min/max so that nan passes through, as it
+    # does through np.clip.
+    grad = grads[i] * grads_scale
+    if grad > grads_clip:
+        grad = grads_clip
+    elif grad < -grads_clip:
+        grad = -grads_clip
+    gradient_moment[i] = (beta_1 * gradient_moment[i]
+                          + (1 - beta_1) * grad)
+    gradient_square_moment[i] = (beta_2 * gradient_square_moment[i]
+                                 + (1 - beta_2) * grad * grad)
+    params[i] -= (step_size * gradient_moment[i]
+                  / (np.sqrt(gradient_square_moment[i]) + epsilon_hat))
+
+
+@jit(_ADAM_STEP_SIGNATURE, nopython=True, error_model="numpy",
+     fastmath={"contract"}, cache=True)
+def _adam_step(params, grads, gradient_moment, gradient_square_moment,
+               grads_scale, grads_clip, step_size, beta_1, beta_2,
+               epsilon_hat):
+    """
+    Perform the Adam update in place on flat, C-contiguous float64 arrays.
+    Gradient scaling and clipping, the moment updates and the parameter
+    step are fused into a single pass so that no temporaries are
+    allocated. Each gradient is multiplied by `grads_scale` and then
+    clipped to [-grads_clip, grads_clip]. The bias corrections are
+    expected to be folded into `step_size` and `epsilon_hat`.
+    """
+    for i in range(params.size):
+        _adam_step_element(i, params, grads, gradient_moment,
+                           gradient_square_moment, grads_scale, grads_clip,
+                           step_size, beta_1, beta_2, epsilon_hat)
+    #ENDFOR
+
+
+@jit(_ADAM_STEP_SIGNATURE, nopython=True, parallel=True,
+     error_model="numpy", fastmath={"contract"}, cache=True)
+def _adam_step_parallel(params, grads, gradient_moment,
+                        gradient_square_moment, grads_scale, grads_clip,
+                        step_size, beta_1, beta_2, epsilon_hat):
+    """
+    See `_adam_step`. The elements are independent, so they are
+    distributed over numba's threads.
+    """
+    for i in prange(params.size):
+        _adam_step_element(i, params, grads, gradient_moment,
+                           gradient_square_moment, grads_scale, grads_clip,
+                           step_size, beta_1, beta_2, epsilon_hat)
+    #ENDFOR
+
+
 class Adam(object):
     """
     a class to define the Adam optimizer
@@ -16,13 +94,18 @@ class Adam(object):
     apply_learning_rate_decay :: bool - see learning_rate_decay
     apply_scale_grads :: bool - see scale_grads
     beta_1 :: float - gradient decay bias
+    beta_1_power :: float - beta_1 raised to the current iteration count
     beta_2 :: float - gradient squared decay bias
+    beta_2_power :: float - beta_2 raised to the current iteration count
     clip_grads :: float - the maximum absolute value at which the gradients
         should be element-wise clipped, if not set, the gradients will
         not be clipped
     epsilon :: float - fuzz factor
     gradient_moment :: numpy.ndarray - running optimization variable
     gradient_square_moment :: numpy.ndarray - running optimization variable
+    grads_buffer :: numpy.ndarray - scratch space that receives the scaled
+        and clipped gradients on the NumPy update path so the caller's
+        gradients are not modified (allocated by `run` only for that path)
     initial_learning_rate :: float - the initial step size
     iteration_count :: int - the current count of iterations performed
     learning_rate :: float - the current step size
@@ -33,6 +116,12 @@ class Adam(object):
     name :: str - identifier for the optimizer
     scale_grads :: float - the value to scale the norm of the gradients to,
         if not set, the gradients will not be scaled
+    update_buffer :: numpy.ndarray - scratch space for the NumPy update
+        path, which avoids allocating temporaries each iteration
+        (allocated by `run` only for that path)
+    update_step :: (numpy.ndarray, numpy.ndarray) -> numpy.ndarray
+        - the update procedure specialized to the enabled options,
+        built when `run` is called
     """
     name = "adam"
 
@@ -59,16 +148,21 @@ class Adam(object):
         else:
             self.apply_learning_rate_decay = True
         self.beta_1 = beta_1
+        self.beta_1_power = 1.
         self.beta_2 = beta_2
+        self.beta_2_power = 1.
         self.clip_grads = clip_grads
         self.epsilon = epsilon
         self.gradient_moment = None
         self.gradient_square_moment = None
+        self.grads_buffer = None
         self.initial_learning_rate = learning_rate
         self.iteration_count = 0
         self.learning_rate = learning_rate
         self.learning_rate_decay = learning_rate_decay
         self.scale_grads = scale_grads
+        self.update_buffer = None
+        self.update_step = None
 
 
     def __str__(self):
@@ -96,27 +190,32 @@ class Adam(object):
         Returns: none
         """
         self.iteration_count = 0
-        self.gradient_moment = np.zeros_like(initial_params)
-        self.gradient_square_moment = np.zeros_like(initial_params)
+        self.beta_1_power = 1.
+        self.beta_2_power = 1.
+        # The running variables are floating even for integer params.
+        dtype = np.result_type(initial_params, np.float64)
+        self.gradient_moment = np.zeros_like(initial_params, dtype=dtype,
+                                             order="C")
+        self.gradient_square_moment = np.zeros_like(initial_params,
+                                                    dtype=dtype, order="C")
+        self.update_step = self._specialize_update_step()
 
         params = initial_params
+        update_step = self.update_step
         for i in range(iteration_count):
             grads, terminate = jacobian(params, *args)
             if terminate:
                 break
-            params = self.update(grads, params)
+            params = update_step(grads, params)
 
 
     def update(self, grads, params):
         """Update the learning parameters for the current iteration.
-        
-        IMPLEMENTATION NOTE: I believe it is faster to check the modification
-        conditionals each iteration than it would be to define seperate
-        functions to do the same work and then call update_vanilla with
-        modified parameters. Namely, because each function call requires a
-        stack context change. It would be faster altogether if there was a
-        seperate update function for each combination of modifications,
-        but that would create duplicate code, which I want to avoid.
+        The update procedure is specialized to the enabled options
+        when `run` is called, see `_specialize_update_step`. If `run` was
+        given real params, the gradients must also be real; complex
+        gradients raise a TypeError rather than losing their imaginary
+        part.
 
         Args:
         grads :: numpy.ndarray - the gradients of the cost function with
@@ -128,38 +227,164 @@ class Adam(object):
         new_params :: numpy.ndarray - the learning parameters to be used
             for the next iteration
         """
-        # Apply learning rate decay.
+        return self.update_step(grads, params)
+
+
+    def _specialize_update_step(self):
+        """Build the update procedure for the options that are enabled.
+
+        IMPLEMENTATION NOTE: Checking the modification conditionals and
+        looking up the optimizer's fields every iteration is measurable
+        against the arithmetic for small to medium parameter counts.
+        Instead, the conditionals are resolved once here and the constants
+        are bound to closure variables, so the returned function only
+        touches the running state. The gradient conditioning and the
+        moment update are picked separately rather than writing a
+        function for each combination of modifications, which would
+        create duplicate code.
+
+        Returns:
+        update_step :: (numpy.ndarray, numpy.ndarray) -> numpy.ndarray
+            - a function with the signature of `update`
+        """
+        beta_1 = self.beta_1
+        beta_2 = self.beta_2
+        clip_grads = self.clip_grads
+        epsilon = self.epsilon
+        gradient_moment = self.gradient_moment
+        gradient_square_moment = self.gradient_square_moment
+        initial_learning_rate = self.initial_learning_rate
+        scale_grads = self.scale_grads
+
+        # Choose how the learning rate decays.
         if self.apply_learning_rate_decay:
-            learning_rate = (self.initial_learning_rate
-                             * np.exp(-np.divide(self.iteration_count,
-                                                 self.learning_rate_decay)))
+            learning_rate_decay = self.learning_rate_decay
+            def get_learning_rate(iteration_count):
+                return (initial_learning_rate
+                        * np.exp(-np.divide(iteration_count,
+                                            learning_rate_decay)))
         else:
-            learning_rate = self.initial_learning_rate
+            def get_learning_rate(iteration_count):
+                return initial_learning_rate
+        #ENDIF
 
-        # Apply gradient scaling (before clipping).
+        # Choose how the gradients are scaled. The norm is taken before
+        # clipping. np.vdot flattens and conjugates its first argument, so
+        # it yields the squared 2-norm of real and complex gradients alike
+        # through a single BLAS call.
         if self.apply_scale_grads:
-            grads_norm = np.linalg.norm(grads)
-            grads = (grads / grads_norm) * self.scale_grads
+            def get_grads_scale(grads):
+                return scale_grads / np.sqrt(np.real(np.vdot(grads, grads)))
+        else:
+            def get_grads_scale(grads):
+                return 1.
+        #ENDIF
 
-        # Apply gradient clipping.
-        if self.apply_clip_grads:
-            grads = np.clip(grads, -self.clip_grads, self.clip_grads)
+        # Choose how the gradients are conditioned and how the moments
+        # and params are updated. Real-valued optimizations, which is
+        # everything in optimizer format, take the fused kernel, which
+        # also scales and clips each gradient as it is read.
+        if gradient_moment.dtype == np.float64:
+            # No clipping is expressed as clipping at infinity.
+            if self.apply_clip_grads:
+                grads_clip = clip_grads
+            else:
+                grads_clip = np.inf
+            if gradient_moment.size >= ADAM_PARALLEL_SIZE_MIN:
+                adam_step = _adam_step_parallel
+            else:
+                adam_step = _adam_step
+            self.grads_buffer = None
+            self.update_buffer = None
+            gradient_moment_flat = np.ravel(gradient_moment)
+            gradient_square_moment_flat = np.ravel(gradient_square_moment)
+            # The kernel does no bounds checking, so the params and grads
+            # are broadcast to the shape of the moments first. This raises
+            # for mismatched shapes, and expands scalars, as the NumPy path
+            # would.
+            moment_shape = gradient_moment.shape
+            def apply_update(grads, params, step_size, epsilon_hat):
+                if np.iscomplexobj(grads):
+                    raise TypeError("Adam was run with real params, which "
+                                    "take the real-valued update, but "
+                                    "received complex grads. Convert the "
+                                    "params to optimizer format, or run "
+                                    "with complex params.")
+                new_params = np.array(np.broadcast_to(params, moment_shape),
+                                      dtype=np.float64, order="C")
+                grads_flat = np.ravel(np.broadcast_to(
+                    np.asarray(grads, dtype=np.float64), moment_shape))
+                adam_step(np.ravel(new_params), grads_flat,
+                          gradient_moment_flat, gradient_square_moment_flat,
+                          get_grads_scale(grads), grads_clip,
+                          step_size, beta_1, beta_2, epsilon_hat)
+                return new_params
+        else:
+            # The kernel needs no scratch space, so the buffers are only
+            # allocated here.
+            self.grads_buffer = grads_buffer = np.zeros_like(gradient_moment)
+            self.update_buffer = update_buffer = np.zeros_like(gradient_moment)
 
+            # Condition the gradients into the grads buffer so the caller's
+            # gradients are not modified.
+            if self.apply_scale_grads and self.apply_clip_grads:
+                def condition_grads(grads):
+                    np.multiply(grads, get_grads_scale(grads), out=grads_buffer)
+                    return np.clip(grads_buffer, -clip_grads, clip_grads,
+                                   out=grads_buffer)
+            elif self.apply_scale_grads:
+                def condition_grads(grads):
+                    return np.multiply(grads, get_grads_scale(grads),
+                                       out=grads_buffer)
+            elif self.apply_clip_grads:
+                def condition_grads(grads):
+                    return np.clip(grads, -clip_grads, clip_grads,
+                                   out=grads_buffer)
+            else:
+                def condition_grads(grads):
+                    return grads
+            #ENDIF
 
-        # Do the vanilla update procedure.
-        self.iteration_count += 1
-        beta_1 = self.beta_1
-        beta_2 = self.beta_2
-        iteration_count = self.iteration_count
-        self.gradient_moment = (beta_1 * self.gradient_moment
-                                + (1 - beta_1) * grads)
-        self.gradient_square_moment = (beta_2 * self.gradient_square_moment
-                                       + (1 - beta_2) * np.square(grads))
-        gradient_moment_hat = np.divide(self.gradient_moment,
-                                        1 - np.power(beta_1, iteration_count))
-        gradient_square_moment_hat = np.divide(self.gradient_square_moment,
-                                               1 - np.power(beta_2, iteration_count))
-        
-        return params - learning_rate * np.divide(gradient_moment_hat,
-                                                  np.sqrt(gradient_square_moment_hat)
-                                                  + self.epsilon)
+            # Update the moments in place and stage the step in the update
+            # buffer so that the only allocation is the returned params.
+            def apply_update(grads, params, step_size, epsilon_hat):
+                grads = condition_grads(grads)
+                np.multiply(gradient_moment, beta_1, out=gradient_moment)
+                np.multiply(grads, 1 - beta_1, out=update_buffer)
+                np.add(gradient_moment, update_buffer, out=gradient_moment)
+                np.multiply(gradient_square_moment, beta_2,
+                            out=gradient_square_moment)
+                np.square(grads, out=update_buffer)
+                np.multiply(update_buffer, 1 - beta_2, out=update_buffer)
+                np.add(gradient_square_moment, update_buffer,
+                       out=gradient_square_moment)
+                np.sqrt(gradient_square_moment, out=update_buffer)
+                np.add(update_buffer, epsilon_hat, out=update_buffer)
+                np.divide(gradient_moment, update_buffer, out=update_buffer)
+                np.multiply(update_buffer, step_size, out=update_buffer)
+                
+                return np.subtract(params, update_buffer)
+        #ENDIF
+
+        def update_step(grads, params):
+            # Apply learning rate decay.
+            iteration_count = self.iteration_count
+            learning_rate = get_learning_rate(iteration_count)
+
+            # Do the vanilla update procedure. The bias corrections
+            # m / (1 - beta_1 ^ t) and v / (1 - beta_2 ^ t) are folded into
+            # the scalars step_size and epsilon_hat, which is equivalent
+            # and saves two passes over the moments. The powers of the betas
+            # are accumulated across iterations rather than recomputed.
+            self.iteration_count = iteration_count + 1
+            beta_1_power = self.beta_1_power = self.beta_1_power * beta_1
+            beta_2_power = self.beta_2_power = self.beta_2_power * beta_2
+            bias_correction_2_sqrt = np.sqrt(1 - beta_2_power)
+            step_size = (learning_rate * bias_correction_2_sqrt
+                         / (1 - beta_1_power))
+            epsilon_hat = epsilon * bias_correction_2_sqrt
+
+            return apply_update(grads, params, step_size, epsilon_hat)
+        #ENDDEF
+
+        return update_step
@@ -7,20 +7,9 @@ import os
 
 from filelock import FileLock, Timeout
 import h5py
-import matplotlib
-if not "DISPLAY" in os.environ:
-    matplotlib.use("Agg")
-import matplotlib.patches as mpatches
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
 import numpy as np
-from scipy import linalg as la
-from qutip import *
-from IPython import display
-import pandas as pd
 
 from qoc.models import ProgramType
-from qoc.standard.functions.convenience import conjugate_transpose
 
 ### CONSTANTS ###
 
@@ -31,6 +20,10 @@ COLOR_PALETTE = (
 )
 COLOR_PALETTE_LEN = len(COLOR_PALETTE)
 
+# Whether or not the matplotlib backend has been chosen, see
+# `_import_matplotlib`.
+_MATPLOTLIB_CONFIGURED = False
+
 ### MAIN METHODS ###
 
 def plot_controls(file_path, amplitude_unit="GHz", 
@@ -69,9 +62,9 @@ def plot_controls(file_path, amplitude_unit="GHz",
                 # If no save_index was specified, choose the save_index that achieved the lowest
                 # error.
                 if save_index is None:
-                    save_index = np.argmin(file_["error"])
+                    save_index = np.argmin(file_["error"][()])
                 complex_controls = file_["complex_controls"][()]
-                controls = file_["controls"][save_index][()]
+                controls = file_["controls"][save_index, :, :]
                 evolution_time = file_["evolution_time"][()]
     except Timeout:
         print("Could not access specified file.")
@@ -81,26 +74,32 @@ def plot_controls(file_path, amplitude_unit="GHz",
     control_eval_count = controls.shape[0]
     control_eval_times = np.linspace(0, evolution_time, control_eval_count)
     control_dt = control_eval_times[1] - control_eval_times[0]
+    # For complex controls np.real and np.imag are strided views into
+    # `controls`. For real controls np.real returns `controls` itself while
+    # np.imag would allocate zeros, so the imaginary part is only taken
+    # when it is plotted.
     controls_real = np.real(controls)
-    controls_imag = np.imag(controls)
     file_name = os.path.splitext(ntpath.basename(file_path))[0]
     if title is None:
         title = file_name
 
-    # Create labels and extra content.
+    mpatches, plt = _import_matplotlib()
+
+    # Create labels and extra content. The real and imaginary parts
+    # of control i take colors 2i and 2i + 1.
+    colors = get_colors(2 * control_count)
+    colors_real = colors[0::2]
+    colors_imag = colors[1::2]
     patches = list()
     labels = list()
     for i in range(control_count):
-        i2 = i * 2
         label_real = "control_{}_real".format(i)
         labels.append(label_real)
-        color_real = get_color(i2)
-        patches.append(mpatches.Patch(label=label_real, color=color_real))
+        patches.append(mpatches.Patch(label=label_real, color=colors_real[i]))
 
         label_imag = "control_{}_imag".format(i)
-        color_imag = get_color(i2 + 1)
         labels.append(label_imag)
-        patches.append(mpatches.Patch(label=label_imag, color=color_imag))
+        patches.append(mpatches.Patch(label=label_imag, color=colors_imag[i]))
     #ENDFOR
 
     # Set up the plots.
@@ -114,45 +113,39 @@ def plot_controls(file_path, amplitude_unit="GHz",
     plt.subplot(2, 1, 1)
     plt.xlabel("Time ({})".format(time_unit))
     plt.ylabel("Amplitude ({})".format(amplitude_unit))
+    # Each column is a control, and matplotlib draws one line per column
+    # taking colors from the axes' property cycle.
+    plt.gca().set_prop_cycle(color=colors_real)
+    plt.plot(control_eval_times, controls_real, marker_style,
+             ms=2, alpha=0.9)
     if complex_controls:
-        for i in range(control_count):
-            i2 = i * 2
-            color_real = get_color(i2)
-            color_imag = get_color(i2 + 1)
-            control_real = controls_real[:, i]
-            control_imag = controls_imag[:, i]
-            plt.plot(control_eval_times, control_real, marker_style,
-                     color=color_real, ms=2, alpha=0.9)
-            plt.plot(control_eval_times, control_imag, marker_style,
-                     color=color_imag, ms=2, alpha=0.9)
-    else:
-        for i in range(control_count):
-            i2 = i * 2
-            color= get_color(i2)
-            control = controls[:, i]
-            plt.plot(control_eval_times, control, marker_style,
-                     color=color, ms=2, alpha=0.9)
+        controls_imag = np.imag(controls)
+        plt.gca().set_prop_cycle(color=colors_imag)
+        plt.plot(control_eval_times, controls_imag, marker_style,
+                 ms=2, alpha=0.9)
     #ENDIF
 
-    # Plot the fft.
+    # Plot the fft. Transform every control at once; real controls
+    # have a hermitian spectrum so only the non-negative half is needed.
     ax = plt.subplot(2, 1, 2)
-    freq_axis = np.fft.fftfreq(control_eval_count, d=control_dt)
     if complex_controls:
-        for i in range(control_count):
-            i2 = i * 2
-            color_fft_real = get_color(i2)
-            color_fft_imag = get_color(i2 + 1)
-            control_fft_real = np.real(np.fft.fft(controls[:, i]))
-            control_fft_imag = np.imag(np.fft.fft(controls[:, i]))
-            control_fft_squared_real = np.real(control_fft_real * np.conj(control_fft_real))
-            control_fft_squared_imag = np.real(control_fft_imag * np.conj(control_fft_imag))
-            ax.plot(freq_axis,
-                    control_fft_squared_real, marker_style, color=color_fft_real,
-                    ms=2,alpha=0.9)
-            ax.plot(freq_axis,
-                    control_fft_squared_imag, marker_style, color=color_fft_imag,
-                    ms=2,alpha=0.9)
-    #ENDFOR
+        freq_axis = np.fft.fftfreq(control_eval_count, d=control_dt)
+        controls_fft = np.fft.fft(controls, axis=0)
+        controls_fft_squared_real = np.square(np.real(controls_fft))
+        controls_fft_squared_imag = np.square(np.imag(controls_fft))
+        ax.set_prop_cycle(color=colors_real)
+        ax.plot(freq_axis, controls_fft_squared_real, marker_style,
+                ms=2, alpha=0.9)
+        ax.set_prop_cycle(color=colors_imag)
+        ax.plot(freq_axis, controls_fft_squared_imag, marker_style,
+                ms=2, alpha=0.9)
+    else:
+        freq_axis = np.fft.rfftfreq(control_eval_count, d=control_dt)
+        controls_fft_squared = np.square(np.abs(np.fft.rfft(controls_real, axis=0)))
+        ax.set_prop_cycle(color=colors_real)
+        ax.plot(freq_axis, controls_fft_squared, marker_style,
+                ms=2, alpha=0.9)
+    #ENDIF
     ax.set_xlabel("Frequency ({})".format(amplitude_unit))
     ax.set_ylabel("FFT")
     
@@ -183,7 +176,7 @@ def plot_density_population(file_path,
                             save_index=None,
                             show=False,
                             time_unit="ns",
-                            titile=None):
+                            title=None):
     """
     Plot the evolution of the population levels for a density matrix.
 
@@ -214,8 +207,8 @@ def plot_density_population(file_path,
                     # If no save index was specified, choose the index that achieved
                     # the lowest error.
                     if save_index is None:
-                        save_index = np.argmin(file_["error"])
-                        intermediate_densities = file_["intermediate_densities"][save_index, :, density_index, :, :]
+                        save_index = np.argmin(file_["error"][()])
+                    intermediate_densities = file_["intermediate_densities"][save_index, :, density_index, :, :]
             #ENDWITH
         #ENDWITH
     except Timeout:
@@ -227,20 +220,19 @@ def plot_density_population(file_path,
     hilbert_size = intermediate_densities.shape[-2]
     system_eval_times = np.linspace(0, evolution_time, system_eval_count)
 
-    # Compile data.
-    population_data = list()
-    for i in range(hilbert_size):
-        population_data_ = np.real(intermediate_densities[:, i, i])
-        population_data.append(population_data_)
+    # Compile data. Only the diagonal of each density is needed.
+    population = np.real(np.einsum("tii->ti", intermediate_densities))
+
+    mpatches, plt = _import_matplotlib()
 
     # Create labels and extra content.
+    colors = get_colors(hilbert_size)
     patches = list()
     labels = list()
     for i in range(hilbert_size):
         label = "{}".format(i)
         labels.append(label)
-        color = get_color(i)
-        patches.append(mpatches.Patch(label=label, color=color))
+        patches.append(mpatches.Patch(label=label, color=colors[i]))
     #ENDFOR
 
     # Plot the data.
@@ -250,10 +242,10 @@ def plot_density_population(file_path,
                   framealpha=0.5)
     plt.xlabel("Time ({})".format(time_unit))
     plt.ylabel("Population")
-    for i in range(hilbert_size):
-        color = get_color(i)
-        plt.plot(system_eval_times, population_data[i], marker_style,
-                 color=color, ms=2, alpha=0.9)
+    # Each column of the population is a level.
+    plt.gca().set_prop_cycle(color=colors)
+    plt.plot(system_eval_times, population, marker_style,
+             ms=2, alpha=0.9)
 
     # Export.
     if save_file_path is not None:
@@ -301,7 +293,7 @@ def plot_state_population(file_path,
                     # If no save index was specified, choose the index that achieved
                     # the lowest error.
                     if save_index is None:
-                        save_index = np.argmin(file_["error"])
+                        save_index = np.argmin(file_["error"][()])
                     intermediate_states = file_["intermediate_states"][save_index, :, state_index, :, :]
             #ENDWITH
         #ENDWITH
@@ -314,21 +306,23 @@ def plot_state_population(file_path,
     hilbert_size = intermediate_states.shape[-2]
     system_eval_times = np.linspace(0, evolution_time, system_eval_count)
 
-    # Compile data.
-    intermediate_densities = np.matmul(intermediate_states, conjugate_transpose(intermediate_states))
-    population_data = list()
-    for i in range(hilbert_size):
-        population_data_ = np.real(intermediate_densities[:, i, i])
-        population_data.append(population_data_)
+    # Compile data. The population of level i is the diagonal element
+    # (psi psi^dagger)_ii = sum_j psi_ij conj(psi_ij), which is contracted
+    # directly so that neither the density nor the conjugate transpose
+    # is formed.
+    population = np.real(np.einsum("tij,tij->ti", intermediate_states,
+                                   np.conj(intermediate_states)))
+
+    mpatches, plt = _import_matplotlib()
 
     # Create labels and extra content.
+    colors = get_colors(hilbert_size)
     patches = list()
     labels = list()
     for i in range(hilbert_size):
         label = "{}".format(i)
         labels.append(label)
-        color = get_color(i)
-        patches.append(mpatches.Patch(label=label, color=color))
+        patches.append(mpatches.Patch(label=label, color=colors[i]))
     #ENDFOR
 
     # Plot the data.
@@ -338,10 +332,10 @@ def plot_state_population(file_path,
                   framealpha=0.5)
     plt.xlabel("Time ({})".format(time_unit))
     plt.ylabel("Population")
-    for i in range(hilbert_size):
-        color = get_color(i)
-        plt.plot(system_eval_times, population_data[i], marker_style,
-                 color=color, ms=2, alpha=0.9)
+    # Each column of the population is a level.
+    plt.gca().set_prop_cycle(color=colors)
+    plt.plot(system_eval_times, population, marker_style,
+             ms=2, alpha=0.9)
 
     # Export.
     if save_file_path is not None:
@@ -364,3 +358,43 @@ def get_color(index):
     color
     """
     return COLOR_PALETTE[index % COLOR_PALETTE_LEN]
+
+
+def get_colors(count):
+    """
+    Retrieve the colors for indices `0` through `count - 1`,
+    as given by `get_color`.
+
+    Arguments:
+    count
+
+    Returns:
+    colors :: list
+    """
+    return [COLOR_PALETTE[index % COLOR_PALETTE_LEN]
+            for index in range(count)]
+
+
+def _import_matplotlib():
+    """
+    Import the matplotlib modules used for plotting. matplotlib is
+    loaded on the first plot rather than with this module, so that
+    programs that do not plot do not pay for the import. If there is
+    no display, the non-interactive Agg backend is chosen first.
+
+    Arguments: None
+
+    Returns:
+    mpatches :: module - matplotlib.patches
+    plt :: module - matplotlib.pyplot
+    """
+    global _MATPLOTLIB_CONFIGURED
+    if not _MATPLOTLIB_CONFIGURED:
+        import matplotlib
+        if not "DISPLAY" in os.environ:
+            matplotlib.use("Agg")
+        _MATPLOTLIB_CONFIGURED = True
+    import matplotlib.patches as mpatches
+    import matplotlib.pyplot as plt
+
+    return mpatches, plt
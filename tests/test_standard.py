@@ -275,6 +275,12 @@ def test_adam():
     assert(np.allclose(params1_test, params1))
     assert(np.allclose(params2_test, params2))
 
+    # Check that integer params are optimized as floats.
+    adam.run(None, 0, grads, None, None)
+    params1_test = adam.update(params, grads)
+    
+    assert(np.allclose(params1_test, params1))
+
     # Check that complex mapping works and params
     # without gradients are unaffected.
     gstate = Dummy()
@@ -297,6 +303,88 @@ def test_adam():
     assert(np.allclose(params1[0][1], params[0][1]))
     assert(np.allclose(params1[1][0], params[1][0]))
 
+    # Check that the fused kernel follows numpy semantics, rather than
+    # raising, when the squared gradient overflows and when there is
+    # no fuzz factor to guard a zero gradient.
+    adam = Adam()
+    params = np.ones(2)
+    adam.run(None, 0, params, None, None)
+    params1 = adam.update(np.array([1e200, 1]), params)
+    assert(np.allclose(params1, np.array([1, 0.999])))
+    adam = Adam(epsilon=0.)
+    adam.run(None, 0, params, None, None)
+    params1 = adam.update(np.array([0., 1]), params)
+    assert(np.isnan(params1[0]))
+    assert(np.allclose(params1[1], 0.999))
+
+    # Check that the fused kernel, which real params take, scales
+    # and clips the gradients the same way as the NumPy path.
+    adam = Adam(clip_grads=0.4, scale_grads=2)
+    adam_numpy = Adam(clip_grads=0.4, scale_grads=2)
+    grads = np.array([0.1, -0.5, 2, 0.3, -1])
+    params = np.ones(5)
+    params_numpy = np.ones(5, dtype=np.complex128)
+    adam.run(None, 0, params, None, None)
+    adam_numpy.run(None, 0, params_numpy, None, None)
+    for i in range(3):
+        params = adam.update(grads, params)
+        params_numpy = adam_numpy.update(grads, params_numpy)
+    
+    assert(np.allclose(params, np.real(params_numpy)))
+    assert(np.allclose(grads, np.array([0.1, -0.5, 2, 0.3, -1])))
+
+    # Check that the fused kernel broadcasts a scalar gradient and
+    # rejects gradients whose shape does not match the params.
+    adam = Adam()
+    adam.run(None, 0, np.zeros(3), None, None)
+    params1 = adam.update(np.float64(1.), np.zeros(3))
+    assert(np.allclose(params1, np.repeat(-0.001, 3)))
+    adam.run(None, 0, np.zeros(12), None, None)
+    try:
+        adam.update(np.ones(2), np.zeros(12))
+        assert(False)
+    except ValueError:
+        pass
+
+    # Complex gradients are rejected rather than truncated when the
+    # optimizer was run with real params.
+    adam.run(None, 0, np.zeros(2), None, None)
+    try:
+        adam.update(np.array([1+1j, 1]), np.zeros(2))
+        assert(False)
+    except TypeError:
+        pass
+
+    # Check that the threaded kernel, which large real params take,
+    # agrees with the NumPy path.
+    from qoc.standard.optimizers.adam import ADAM_PARALLEL_SIZE_MIN
+    adam = Adam(clip_grads=0.02, scale_grads=2)
+    adam_numpy = Adam(clip_grads=0.02, scale_grads=2)
+    size = ADAM_PARALLEL_SIZE_MIN + 1
+    grads = np.sin(np.arange(size))
+    params = np.ones(size)
+    params_numpy = np.ones(size, dtype=np.complex128)
+    adam.run(None, 0, params, None, None)
+    adam_numpy.run(None, 0, params_numpy, None, None)
+    for i in range(3):
+        params = adam.update(grads, params)
+        params_numpy = adam_numpy.update(grads, params_numpy)
+
+    assert(np.allclose(params, np.real(params_numpy)))
+
+    # A nan gradient is not hidden by clipping on either path.
+    adam = Adam(clip_grads=0.4)
+    adam_numpy = Adam(clip_grads=0.4)
+    grads = np.array([np.nan, 1])
+    adam.run(None, 0, np.ones(2), None, None)
+    adam_numpy.run(None, 0, np.ones(2, dtype=np.complex128), None, None)
+    params = adam.update(grads, np.ones(2))
+    with np.errstate(invalid="ignore"):
+        params_numpy = adam_numpy.update(grads, np.ones(2, dtype=np.complex128))
+    
+    assert(np.isnan(params[0]) and np.isnan(params_numpy[0]))
+    assert(np.allclose(params[1], np.real(params_numpy[1])))
+
 
 def test_sgd():
     import numpy as np